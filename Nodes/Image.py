@@ -1,13 +1,861 @@
+import atexit
+import glob
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 from uuid import uuid4
 
+import numpy as np
 import torch
 from comfy.model_management import InterruptProcessingException
 from folder_paths import get_input_directory, get_output_directory
-from PIL import Image, ImageSequence
+from PIL import GifImagePlugin, Image
 from torchvision.transforms import functional as TF
 from torchvision.utils import make_grid
 
+ARCHIVES = (".tar", ".tar.bz2", ".tar.gz", ".tar.xz", ".tgz", ".zip")
+COMPRESSED = (".tar.bz2", ".tar.gz", ".tar.xz", ".tgz")
+EXTENSIONS = {".bmp", ".gif", ".jpeg", ".jpg", ".png", ".webp"}
+SORTS = {
+    "name": lambda f: f[0],
+    "natural": lambda f: [
+        int(t) if t.isdigit() else t for t in re.split(r"([0-9]+)", f[0])
+    ],
+    "modified": lambda f: (f[2], f[0]),
+    "size": lambda f: (f[1], f[0]),
+}
+
+RATIOS = [1 / 2, 9 / 16, 2 / 3, 3 / 4, 4 / 5, 1, 5 / 4, 4 / 3, 3 / 2, 16 / 9, 2]
+CACHE = Path(__file__).parents[1] / "cache"
+CURSORS = Path(__file__).parents[1] / "cursors.json"
+FORMATS = {"gif": "GIF", "jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+SUFFIXES = {"apng": "png", "grid": "jpg", "tiles": "dzi"}
+
+_archives = threading.local()
+_encoder = (0, None)
+_errors = []
+_generation = 0
+_handles = []
+_hashes = {}
+_headers = {}
+_index = {}
+_lock = threading.Lock()
+_members = {}
+_pending = threading.BoundedSemaphore(8)
+_shards = {}
+_stream = threading.Lock()
+_wanted = {}
+_writer = None
+
+
+def open_archive(path):
+    if getattr(_archives, "generation", None) != _generation:
+        _archives.generation = _generation
+        _archives.handles = {}
+
+    if path not in _archives.handles:
+        if path.lower().endswith(".zip"):
+            handle = zipfile.ZipFile(path)
+        else:
+            handle = tarfile.open(path)
+
+        with _lock:
+            _handles.append(handle)
+
+        _archives.handles[path] = handle
+
+    return _archives.handles[path]
+
+
+def close_archives():
+    global _generation
+
+    with _lock:
+        for handle in _handles:
+            handle.close()
+
+        _handles.clear()
+        _members.clear()
+        _wanted.clear()
+        _generation += 1
+
+
+def queue_members(files):
+    for file in files:
+        path, sep, _ = file[0].partition("::")
+
+        if sep and path.lower().endswith(COMPRESSED):
+            _wanted.setdefault(path, set()).add(file[0])
+
+
+def stream_members(path, file):
+    # Compressed tars can't seek, so every selected member is read in a single
+    # ordered pass the first time one of them is needed.
+    with _stream:
+        if file not in _members:
+            wanted = _wanted.pop(path, {file})
+
+            with tarfile.open(path, "r|*") as handle:
+                for info in handle:
+                    name = f"{path}::{info.name}"
+
+                    if name in wanted:
+                        _members[name] = handle.extractfile(info).read()
+
+        return io.BytesIO(_members[file])
+
+
+def open_source(file):
+    path, sep, member = file.partition("::")
+
+    if not sep or not path.lower().endswith(ARCHIVES):
+        return open(file, "rb")
+
+    if path.lower().endswith(COMPRESSED):
+        return stream_members(path, file)
+
+    handle = open_archive(path)
+
+    if isinstance(handle, zipfile.ZipFile):
+        return handle.open(member)
+
+    return handle.extractfile(member)
+
+
+def archive_members(path):
+    mtime = os.stat(path).st_mtime_ns
+    files = []
+
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as handle:
+            for info in handle.infolist():
+                if not info.is_dir():
+                    files.append((info.filename, info.file_size))
+    else:
+        with tarfile.open(path) as handle:
+            for info in handle:
+                if info.isfile():
+                    files.append((info.name, info.size))
+
+    return [
+        (f"{path}::{name}", size, mtime)
+        for name, size in files
+        if os.path.splitext(name)[1].lower() in EXTENSIONS
+    ]
+
+
+def store_bounded(cache, key, value, limit):
+    with _lock:
+        cache[key] = value
+
+        while len(cache) > limit:
+            cache.pop(next(iter(cache)))
+
+    return value
+
+
+def scan_files(input_dir, recursive):
+    key = (os.path.abspath(input_dir), recursive)
+    indexed = _index.get(key)
+
+    if indexed:
+        try:
+            if all(os.stat(d).st_mtime_ns == m for d, m in indexed[0].items()):
+                return indexed[1]
+        except OSError:
+            pass
+
+    dirs = {}
+    files = []
+
+    if not os.path.isdir(input_dir):
+        paths = sorted(p for p in glob.glob(key[0]) if p.lower().endswith(ARCHIVES))
+        parents = {os.path.dirname(p) for p in [key[0]] + paths}
+
+        for path in [p for p in parents if os.path.isdir(p)] + paths:
+            dirs[path] = os.stat(path).st_mtime_ns
+
+        for path in paths:
+            files.extend(archive_members(path))
+
+        store_bounded(_index, key, (dirs, files), 16)
+        return files
+
+    stack = [os.path.realpath(key[0])]
+
+    while stack:
+        dir = stack.pop()
+
+        if dir in dirs:
+            continue
+
+        dirs[dir] = os.stat(dir).st_mtime_ns
+
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    recursive and stack.append(os.path.realpath(entry.path))
+                elif os.path.splitext(entry.name)[1].lower() in EXTENSIONS:
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+
+    store_bounded(_index, key, (dirs, files), 16)
+    return files
+
+
+def restat_files(files):
+    fresh = []
+
+    for file in files:
+        path, sep, _ = file[0].partition("::")
+
+        if not sep or not path.lower().endswith(ARCHIVES):
+            try:
+                stat = os.stat(file[0])
+            except FileNotFoundError:
+                continue
+
+            file = (file[0], stat.st_size, stat.st_mtime_ns)
+
+        fresh.append(file)
+
+    return fresh
+
+
+def target_size(width, height, size):
+    if width <= height:
+        return (size, int(size * height / width))
+
+    return (int(size * width / height), size)
+
+
+def bucket_size(width, height, size):
+    ratio = min(RATIOS, key=lambda r: abs(math.log(width / height / r)))
+    crop = (int(size / ratio**0.5) // 8 * 8, int(size * ratio**0.5) // 8 * 8)
+    scale = max(crop[0] / height, crop[1] / width)
+    size = (max(crop[1], round(width * scale)), max(crop[0], round(height * scale)))
+    return (size, crop)
+
+
+def clear_alpha(image):
+    alpha = image.getchannel("A")
+
+    if alpha.getextrema()[0]:
+        return image
+
+    mask = alpha.point(lambda a: 255 if a else 0)
+    return Image.composite(image, Image.new("RGBA", image.size), mask)
+
+
+def read_header(file):
+    header = _headers.get(file)
+
+    if header is None:
+        with open_source(file[0]) as fp, Image.open(fp) as image:
+            header = (*image.size, getattr(image, "n_frames", 1))
+            store_bounded(_headers, file, header, 65536)
+
+    return header
+
+
+def select_frames(count, start, stride, limit):
+    if count < 2:
+        return [0]
+
+    return list(range(start, count, stride))[: limit or None]
+
+
+def decode_frames(file, size, crop, frames, out):
+    with open_source(file) as fp, Image.open(fp) as image:
+        image.draft(image.mode, size)
+
+        for index, frame in enumerate(frames):
+            image.seek(frame)
+            frame = clear_alpha(image.convert("RGBA"))
+
+            if frame.size != size:
+                frame = frame.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+            left = int(round((frame.width - crop[1]) / 2.0))
+            top = int(round((frame.height - crop[0]) / 2.0))
+            frame = frame.crop((left, top, left + crop[1], top + crop[0]))
+            out[index] = np.asarray(frame)
+
+
+def load_cached(file, size, crop, frames, out):
+    key = repr((file, size, crop, frames)).encode()
+    path = CACHE / f"{hashlib.sha1(key).hexdigest()}.npy"
+
+    try:
+        out[:] = np.load(path, mmap_mode="r")
+        os.utime(path)
+        return
+    except (OSError, ValueError):
+        pass
+
+    decode_frames(file[0], size, crop, frames, out)
+    temp = path.with_name(f"{path.stem}.{uuid4().hex[:8]}.tmp")
+
+    try:
+        with open(temp, "wb") as f:
+            np.save(f, out)
+
+        os.replace(temp, path)
+    except OSError:
+        temp.unlink(missing_ok=True)
+
+
+def evict_cache(budget):
+    files = []
+
+    with os.scandir(CACHE) as entries:
+        for entry in entries:
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total = sum(f[1] for f in files)
+
+    for _, size, path in sorted(files):
+        if total <= budget:
+            break
+
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def cursor_files(input_dir, files=None):
+    try:
+        with open(CURSORS, "r") as f:
+            cursors = json.load(f)
+    except (OSError, ValueError):
+        cursors = {}
+
+    key = os.path.abspath(input_dir)
+
+    if files is None:
+        return {k: tuple(v) for k, v in cursors.get(key, {}).items()}
+
+    cursors.setdefault(key, {}).update({f[0]: f[1:] for f in files})
+    temp = CURSORS.with_name(f"{CURSORS.name}.{uuid4().hex[:8]}.tmp")
+
+    with open(temp, "w") as f:
+        json.dump(cursors, f)
+
+    os.replace(temp, CURSORS)
+
+
+def split_chunks(files, sizes, frames, length):
+    chunk = []
+    count = 0
+
+    for file, size, selection in zip(files, sizes, frames):
+        while selection:
+            take = selection[: length - count] if length else selection
+            selection = selection[len(take) :]
+            chunk.append((file, size, take))
+            count += len(take)
+
+            if count == length:
+                yield chunk
+                chunk = []
+                count = 0
+
+    if chunk:
+        yield chunk
+
+
+@contextmanager
+def atomic_write(path):
+    temp = path.with_name(f".{path.name}.{uuid4().hex[:8]}.tmp")
+
+    try:
+        yield temp
+        os.replace(temp, path)
+    finally:
+        temp.unlink(missing_ok=True)
+
+
+def save_image(image, path, **kwargs):
+    with atomic_write(path) as temp:
+        image.save(temp, FORMATS[path.suffix[1:]], **kwargs)
+
+
+def palettize_frame(image):
+    if image.mode != "RGBA":
+        return (image.quantize(256), {})
+
+    alpha = image.getchannel("A").point(lambda a: 255 if a < 128 else 0)
+    image = image.convert("RGB").quantize(255)
+    image.putpalette((image.getpalette() + [0] * 768)[:768])
+    image.paste(255, mask=alpha)
+    return (image, {"transparency": 255})
+
+
+def global_palette(images, colors):
+    step = max(1, images.shape[0] // 16)
+    samples = images[::step, :3, ::4, ::4].permute(0, 2, 3, 1)
+    samples = samples.reshape(-1, samples.shape[2], 3).numpy()
+    samples = Image.fromarray(samples).quantize(colors, Image.Quantize.MEDIANCUT)
+    palette = samples.getpalette()[: colors * 3]
+    palette = torch.tensor(palette, dtype=torch.float32).reshape(-1, 3)
+
+    grid = torch.arange(32, dtype=torch.float32) * 8 + 4
+    grid = torch.cartesian_prod(grid, grid, grid)
+    lut = torch.cdist(grid, palette).argmin(dim=1).to(torch.uint8)
+    return (palette.to(torch.uint8).flatten().tolist(), lut)
+
+
+def save_gif(images, path, fps, palette="frame"):
+    params = {"disposal": 2, "duration": 1 / fps * 1000 if fps else 0}
+    masked = images.shape[1] == 4
+
+    if palette == "global":
+        colors, lut = global_palette(images, 255 if masked else 256)
+        colors = (colors + [0] * 768)[:768]
+
+    with atomic_write(path) as temp, open(temp, "wb") as f:
+        for index, image in enumerate(images):
+            if palette == "global":
+                rgb = image[:3].to(torch.int64) >> 3
+                indices = lut[rgb[0] << 10 | rgb[1] << 5 | rgb[2]]
+                info = {}
+
+                if masked:
+                    indices[image[3] < 128] = 255
+                    info = {"transparency": 255}
+
+                image = Image.fromarray(indices.numpy(), "P")
+                image.putpalette(colors)
+            else:
+                image, info = palettize_frame(TF.to_pil_image(image))
+                info = {**info, "include_color_table": True}
+
+            if not index:
+                header, _ = GifImagePlugin.getheader(image.copy(), info={"loop": 0})
+                f.write(b"".join(header))
+
+            f.write(b"".join(GifImagePlugin.getdata(image, **params, **info)))
+
+        f.write(b";")
+
+
+def shrink_strip(strip):
+    if strip.shape[0] % 2:
+        strip = np.concatenate((strip, strip[-1:]))
+
+    if strip.shape[1] % 2:
+        strip = np.concatenate((strip, strip[:, -1:]), axis=1)
+
+    strip = strip.astype(np.uint16)
+    strip = strip[0::2] + strip[1::2]
+    strip = strip[:, 0::2] + strip[:, 1::2]
+    return ((strip + 2) // 4).astype(np.uint8)
+
+
+def save_tiles(images, path, nrow, optimize, tile=256):
+    count, _, height, width = images.shape
+    rows = -(-count // nrow)
+    size = (nrow * width, rows * height)
+    top = math.ceil(math.log2(max(size)))
+    folder = path.with_name(f"{path.stem}_files")
+    widths = [-(-size[0] // 2 ** (top - l)) for l in range(top + 1)]
+    buffers = [np.empty((0, w, 3), np.uint8) for w in widths]
+    pending = [b[:0] for b in buffers]
+    written = [0] * (top + 1)
+
+    for level in range(top + 1):
+        (folder / str(level)).mkdir(parents=True, exist_ok=True)
+
+    def emit(level, strip, last):
+        buffers[level] = np.concatenate((buffers[level], strip))
+
+        while len(buffers[level]) >= tile or (last and len(buffers[level])):
+            band = buffers[level][:tile]
+            buffers[level] = buffers[level][tile:]
+
+            for x in range(0, band.shape[1], tile):
+                name = f"{x // tile}_{written[level]}.jpg"
+                image = Image.fromarray(np.ascontiguousarray(band[:, x : x + tile]))
+                save_image(image, folder / str(level) / name, optimize=optimize)
+
+            written[level] += 1
+
+        if level:
+            strip = np.concatenate((pending[level], strip))
+            even = len(strip) if last else len(strip) // 2 * 2
+            pending[level] = strip[even:]
+
+            if even or last:
+                emit(level - 1, shrink_strip(strip[:even]), last)
+
+    for row in range(rows):
+        strip = np.zeros((height, size[0], 3), np.uint8)
+
+        for col, image in enumerate(images[row * nrow : (row + 1) * nrow]):
+            strip[:, col * width : (col + 1) * width] = image[:3].permute(1, 2, 0)
+
+        emit(top, strip, row == rows - 1)
+
+    with atomic_write(path) as temp, open(temp, "w") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            f'Format="jpg" Overlap="0" TileSize="{tile}">'
+            f'<Size Width="{size[0]}" Height="{size[1]}"/></Image>\n'
+        )
+
+
+def png_chunk(f, type, data):
+    crc = zlib.crc32(type + data)
+    f.write(struct.pack(">I", len(data)) + type + data + struct.pack(">I", crc))
+
+
+def save_apng(images, path, fps, optimize):
+    count, channels, height, width = images.shape
+    delay = (1, fps) if fps else (0, 100)
+    sequence = 0
+
+    with atomic_write(path) as temp, open(temp, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        mode = 6 if channels == 4 else 2
+        png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, mode, 0, 0, 0))
+        png_chunk(f, b"acTL", struct.pack(">II", count, 0))
+
+        for index, image in enumerate(images):
+            rows = image.permute(1, 2, 0).numpy().reshape(height, -1)
+            data = np.empty((height, rows.shape[1] + 1), np.uint8)
+            data[:, 0] = 1
+            data[:, 1 : channels + 1] = rows[:, :channels]
+            data[:, channels + 1 :] = rows[:, channels:] - rows[:, :-channels]
+            data = zlib.compress(data.tobytes(), 9 if optimize else 6)
+
+            control = (sequence, width, height, 0, 0, *delay, 1, 0)
+            png_chunk(f, b"fcTL", struct.pack(">IIIIIHHBB", *control))
+            sequence += 1
+
+            if not index:
+                png_chunk(f, b"IDAT", data)
+            else:
+                png_chunk(f, b"fdAT", struct.pack(">I", sequence) + data)
+                sequence += 1
+
+        png_chunk(f, b"IEND", b"")
+
+
+def content_hash(images, *args):
+    key = hashlib.blake2b(images.numpy().tobytes(), digest_size=16)
+    key.update(repr((tuple(images.shape), *args)).encode())
+    return key.hexdigest()
+
+
+def hash_index(output_dir):
+    if output_dir not in _hashes:
+        _hashes[output_dir] = {}
+        path = output_dir / ".hashes"
+
+        if path.is_file():
+            with open(path) as f:
+                _hashes[output_dir].update(line.split() for line in f if line.strip())
+
+    return _hashes[output_dir]
+
+
+def find_duplicate(output_dir, key):
+    with _lock:
+        name = hash_index(output_dir).get(key)
+
+    if name is not None and (output_dir / name.partition("::")[0]).is_file():
+        return name
+
+
+def link_duplicate(source, path):
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+def record_hashes(output_dir, keys, names):
+    with _lock, open(output_dir / ".hashes", "a") as f:
+        for key, name in zip(keys, names):
+            hash_index(output_dir)[key] = name
+            f.write(f"{key} {name}\n")
+
+
+def open_shard(output_dir):
+    stems = [p.stem[6:] for p in output_dir.glob("shard-*.tar")]
+    number = max((int(s) for s in stems if s.isdigit()), default=-1) + 1
+
+    while True:
+        path = output_dir / f"shard-{number:06d}.tar"
+
+        try:
+            return tarfile.open(path, "x", format=tarfile.GNU_FORMAT)
+        except FileExistsError:
+            number += 1
+
+
+def close_shard(output_dir):
+    handle = _shards.pop(output_dir)
+    handle.close()
+
+
+def save_shard(images, output_dir, optimize, limit):
+    samples = []
+
+    for image in images:
+        key = uuid4().hex[:16]
+        members = [(f"{key}.png", image[:3])]
+
+        if image.shape[0] == 4:
+            members.append((f"{key}.mask.png", image[3]))
+
+        sample = []
+
+        for name, data in members:
+            buffer = io.BytesIO()
+            TF.to_pil_image(data).save(buffer, "PNG", optimize=optimize)
+            sample.append((name, buffer.getvalue()))
+
+        info = {"width": image.shape[2], "height": image.shape[1]}
+        sample.append((f"{key}.json", json.dumps(info).encode()))
+        samples.append(sample)
+
+    entries = []
+
+    with _lock:
+        for sample in samples:
+            if output_dir in _shards and _shards[output_dir].offset >= limit:
+                close_shard(output_dir)
+
+            if output_dir not in _shards:
+                _shards[output_dir] = open_shard(output_dir)
+
+            shard = Path(_shards[output_dir].name).name
+            entries.append((f"{shard}::{sample[0][0]}", sum(len(d) for _, d in sample)))
+
+            for name, data in sample:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                _shards[output_dir].addfile(info, io.BytesIO(data))
+
+        _shards[output_dir].fileobj.flush()
+
+    return entries
+
+
+def log_manifest(output_dir, entries, format, shape, metadata):
+    try:
+        metadata = json.loads(metadata)
+    except ValueError:
+        pass
+
+    with _lock, open(output_dir / "manifest.jsonl", "a") as f:
+        for name, size in entries:
+            entry = {
+                "file": name,
+                "format": format,
+                "shape": shape,
+                "bytes": size,
+                "time": time.time(),
+            }
+
+            if metadata != "":
+                entry["metadata"] = metadata
+
+            f.write(json.dumps(entry) + "\n")
+
+
+def resize_batch(images, size):
+    height, width = images.shape[2:]
+    scale = size / max(height, width)
+
+    if scale >= 1:
+        return images
+
+    shape = (max(1, round(height * scale)), max(1, round(width * scale)))
+    images = torch.nn.functional.interpolate(
+        images.float(), shape, mode="bilinear", antialias=True
+    )
+    return images.round().clamp(0, 255).to(torch.uint8)
+
+
+def encode_image(image, path, optimize):
+    save_image(TF.to_pil_image(image), path, optimize=optimize)
+
+
+def encoder_pool(workers):
+    global _encoder
+
+    # Threads rather than processes: PIL releases the GIL while encoding, and
+    # forking the running server (CUDA, server and writer threads) isn't safe.
+    if _encoder[0] != workers:
+        if _encoder[1] is not None:
+            _encoder[1].shutdown(wait=False)
+
+        _encoder = (workers, ThreadPoolExecutor(workers))
+
+    return _encoder[1]
+
+
+def write_images(
+    images,
+    output_dir,
+    format,
+    optimize,
+    fps,
+    workers=0,
+    palette="frame",
+    dedup="off",
+    shard_mb=1024,
+    manifest=False,
+    metadata="",
+    thumbnails=(),
+):
+    single = format in ("jpg", "png", "tar")
+    fresh = list(range(images.shape[0] if single else 1))
+    source = images
+    linked = []
+    paths = []
+    entries = []
+
+    def output(extension):
+        paths.append(output_dir / f"{uuid4().hex[:16]}.{extension}")
+        return paths[-1]
+
+    if dedup != "off":
+        if single:
+            keys = [content_hash(i, format, optimize) for i in images]
+        else:
+            keys = [content_hash(images, format, optimize, fps, palette)]
+
+        fresh = []
+
+        for index, key in enumerate(keys):
+            name = find_duplicate(output_dir, key)
+
+            if name is None:
+                fresh.append(index)
+            elif dedup == "link" and format not in ("tar", "tiles"):
+                suffix = SUFFIXES.get(format, format)
+                path = output_dir / f"{uuid4().hex[:16]}.{suffix}"
+                link_duplicate(output_dir / name, path)
+                linked.append((index, path))
+
+        keys = [keys[i] for i in fresh]
+
+        if single:
+            images = images[fresh]
+
+    if not fresh:
+        pass
+    elif format == "apng":
+        save_apng(images, output("png"), fps, optimize)
+    elif format == "gif":
+        save_gif(images, output(format), fps, palette)
+    elif format == "webp":
+        pil_images = (TF.to_pil_image(i) for i in images)
+
+        save_image(
+            next(pil_images),
+            output(format),
+            append_images=pil_images,
+            duration=1 / fps * 1000 if fps else 0,
+            loop=0,
+            method=6 if optimize else 4,
+            save_all=True,
+        )
+    elif format == "tar":
+        entries = save_shard(images, output_dir, optimize, shard_mb * 2**20)
+    elif format == "tiles":
+        nrow = fps if fps else int(-(images.shape[0] ** 0.5 // -1))
+        save_tiles(images, output("dzi"), nrow, optimize)
+    elif format == "grid":
+        nrow = fps if fps else int(-(images.shape[0] ** 0.5 // -1))
+        grid = TF.to_pil_image(make_grid(images, nrow=nrow, padding=0))
+        save_image(grid, output("jpg"), optimize=optimize)
+    elif workers > 1 and images.shape[0] > 1:
+        files = [output(format) for _ in images]
+
+        with _lock:
+            pool = encoder_pool(workers)
+            tasks = [
+                pool.submit(encode_image, image, path, optimize)
+                for image, path in zip(images, files)
+            ]
+
+        for task in tasks:
+            task.result()
+    else:
+        for image in images:
+            save_image(TF.to_pil_image(image), output(format), optimize=optimize)
+
+    outputs = list(zip(fresh, paths)) + linked
+
+    if format in ("jpg", "png") and outputs:
+        indices, files = zip(*outputs)
+
+        for size in thumbnails:
+            for image, path in zip(resize_batch(source[list(indices)], size), files):
+                path = path.with_name(f"{path.stem}_{size}{path.suffix}")
+                save_image(TF.to_pil_image(image), path, optimize=optimize)
+
+    if dedup != "off":
+        names = [name for name, _ in entries] + [path.name for path in paths]
+        record_hashes(output_dir, keys, names)
+
+    if manifest:
+        count, channels, height, width = images.shape
+        shape = [height, width, channels]
+
+        if not single:
+            shape.insert(0, count)
+
+        entries += [(path.name, path.stat().st_size) for _, path in outputs]
+        log_manifest(output_dir, entries, format, shape, metadata)
+
+
+def writer_done(future):
+    _pending.release()
+
+    if future.exception():
+        _errors.append(future.exception())
+
+
+def flush_writers():
+    if _writer is not None:
+        _writer.shutdown(wait=True)
+
+    if _encoder[1] is not None:
+        _encoder[1].shutdown(wait=True)
+
+    with _lock:
+        for output_dir in list(_shards):
+            close_shard(output_dir)
+
+
+atexit.register(flush_writers)
+
 
 class Batch:
     @classmethod
@@ -16,54 +864,272 @@ class Batch:
             "required": {
                 "input_dir": ("STRING", {"default": get_input_directory()}),
             },
+            "optional": {
+                "recursive": ([False, True], {"default": False}),
+                "sort": (["none"] + list(SORTS), {"default": "name"}),
+                "workers": ("INT", {"default": 0, "min": 0, "max": 256}),
+                "size": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 8}),
+                "start_frame": ("INT", {"default": 0, "min": 0, "max": 100000}),
+                "frame_stride": ("INT", {"default": 1, "min": 1, "max": 1000}),
+                "max_frames": ("INT", {"default": 0, "min": 0, "max": 100000}),
+                "max_total": ("INT", {"default": 0, "min": 0, "max": 1000000}),
+                "cache_mb": ("INT", {"default": 0, "min": 0, "max": 1048576}),
+                "chunk_size": ("INT", {"default": 0, "min": 0, "max": 100000}),
+                "mode": (["crop", "bucket"], {"default": "crop"}),
+                "incremental": ([False, True], {"default": False}),
+                "limit": ("INT", {"default": 0, "min": 0, "max": 1000000}),
+                "offset": ("INT", {"default": 0, "min": 0, "max": 1000000}),
+                "sample_seed": (
+                    "INT",
+                    {"default": 0, "min": 0, "max": 0xFFFFFFFFFFFFFFFF},
+                ),
+            },
         }
 
+    @classmethod
+    def IS_CHANGED(cls, incremental=False, **kwargs):
+        return float("nan") if incremental else ""
+
     CATEGORY = "Zuellni/Image"
     FUNCTION = "process"
+    OUTPUT_IS_LIST = (True, True)
     RETURN_NAMES = ("IMAGES", "MASKS")
     RETURN_TYPES = ("IMAGE", "MASK")
 
-    def process(self, input_dir):
-        input_dir = Path(input_dir)
-        files = []
+    def load(self, pool, chunk, crop, cache):
+        files, sizes, frames = zip(*chunk)
+        counts = [len(f) for f in frames]
+        offsets = np.cumsum([0] + counts)
+        buffer = np.empty((offsets[-1], *crop, 4), np.uint8)
+        outs = [buffer[o : o + n] for o, n in zip(offsets, counts)]
+        crops = [crop] * len(files)
+
+        if cache:
+            list(pool.map(load_cached, files, sizes, crops, frames, outs))
+        else:
+            paths = [f[0] for f in files]
+            list(pool.map(decode_frames, paths, sizes, crops, frames, outs))
+
+        buffer = torch.from_numpy(buffer)
+        images = buffer[:, :, :, :3].float().div_(255)
+        masks = buffer[:, :, :, 3].float().div_(255)
+        return (images, masks)
+
+    def process(self, **kwargs):
+        try:
+            return self.collect(**kwargs)
+        finally:
+            close_archives()
+
+    def collect(
+        self,
+        input_dir,
+        recursive=False,
+        sort="name",
+        workers=0,
+        size=0,
+        start_frame=0,
+        frame_stride=1,
+        max_frames=0,
+        max_total=0,
+        cache_mb=0,
+        chunk_size=0,
+        mode="crop",
+        incremental=False,
+        limit=0,
+        offset=0,
+        sample_seed=0,
+    ):
+        try:
+            files = scan_files(input_dir, recursive)
+        except OSError:
+            raise InterruptProcessingException()
+
+        # The index only notices files overwritten in place once their directory
+        # changes, so incremental runs stat every candidate to catch those too.
+        if incremental:
+            files = restat_files(files)
+            consumed = cursor_files(input_dir)
+            files = [f for f in files if consumed.get(f[0]) != f[1:]]
 
-        for file in ["bmp", "gif", "jpeg", "jpg", "png", "webp"]:
-            files.extend(input_dir.glob(f"*.{file}"))
+        if sort in SORTS:
+            files = sorted(files, key=SORTS[sort])
+
+        if sample_seed:
+            order = list(range(len(files)))
+            random.Random(sample_seed).shuffle(order)
+            order = sorted(order[offset : offset + limit if limit else None])
+            files = [files[i] for i in order]
+        elif limit or offset:
+            files = files[offset : offset + limit if limit else None]
 
         if not files:
             raise InterruptProcessingException()
 
-        pil_images = []
+        queue_members(files)
+        workers = workers or min(32, (os.cpu_count() or 1) + 4)
+
+        with ThreadPoolExecutor(workers) as pool:
+            headers = list(pool.map(read_header, files))
+            frames = []
+            total = 0
+
+            for _, _, count in headers:
+                frames.append(
+                    select_frames(count, start_frame, frame_stride, max_frames)
+                )
+
+                if max_total:
+                    frames[-1] = frames[-1][: max(max_total - total, 0)]
+
+                total += len(frames[-1])
 
-        for file in files:
-            image = Image.open(file)
+            if not total:
+                raise InterruptProcessingException()
 
-            if getattr(image, "is_animated", True):
-                for frame in ImageSequence.Iterator(image):
-                    pil_images.append(frame.copy().convert("RGBA"))
+            files, headers, frames = zip(
+                *[(f, h, s) for f, h, s in zip(files, headers, frames) if s]
+            )
+
+            if mode == "bucket":
+                dims = sorted(min(w, h) for w, h, _ in headers)
+                base = size or dims[len(dims) // 2] // 8 * 8
+                buckets = [bucket_size(w, h, base) for w, h, _ in headers]
+                sizes, crops = zip(*buckets)
             else:
-                pil_images.append(image.convert("RGBA"))
+                min_dim = size or min(min(w, h) for w, h, _ in headers) // 8 * 8
+                sizes = [target_size(w, h, min_dim) for w, h, _ in headers]
+
+                min_height = min(h for _, h in sizes) // 8 * 8
+                min_width = min(w for w, _ in sizes) // 8 * 8
+                crops = [(min_height, min_width)] * len(files)
+
+            groups = {}
+
+            for index, crop in enumerate(crops):
+                groups.setdefault(crop, []).append(index)
 
+            if cache_mb:
+                CACHE.mkdir(parents=True, exist_ok=True)
+
+            chunks = []
+
+            for crop, group in groups.items():
+                group = [(files[i], sizes[i], frames[i]) for i in group]
+
+                for chunk in split_chunks(*zip(*group), chunk_size):
+                    chunks.append(self.load(pool, chunk, crop, cache_mb))
+
+            if cache_mb:
+                evict_cache(cache_mb * 1024 * 1024)
+
+        # Nodes can't tell whether the rest of the prompt succeeded, so files are
+        # consumed here already and a failing downstream node won't see them again.
+        if incremental:
+            cursor_files(input_dir, files)
+
+        images, masks = zip(*chunks)
+        return (list(images), list(masks))
+
+
+class Pack:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "images": ("IMAGE",),
+                "output_dir": ("STRING", {"default": get_output_directory()}),
+                "name": ("STRING", {"default": "pack"}),
+            },
+            "optional": {
+                "masks": ("MASK",),
+                "names": ("STRING", {"forceInput": True}),
+            },
+        }
+
+    CATEGORY = "Zuellni/Image"
+    FUNCTION = "process"
+    INPUT_IS_LIST = True
+    OUTPUT_NODE = True
+    RETURN_TYPES = ()
+
+    def process(self, images, output_dir, name, masks=None, names=None):
+        output_dir = Path(output_dir[0])
+        output_dir.mkdir(parents=True, exist_ok=True)
+        path = output_dir / f"{name[0]}.bin"
+        temp = path.with_name(f"{path.name}.{uuid4().hex[:8]}.tmp")
+        segments = []
+        offset = 0
+
+        with open(temp, "wb") as f:
+            for index, image in enumerate(images):
+                if masks is not None:
+                    mask = masks[min(index, len(masks) - 1)]
+                    image = torch.cat((image, mask.unsqueeze(-1)), dim=-1)
+
+                image = torch.clamp(image * 255, 0, 255)
+                image = image.to("cpu", torch.uint8).numpy()
+                image.tofile(f)
+
+                segments.append({"offset": offset, "shape": list(image.shape)})
+                offset += image.nbytes
+
+        os.replace(temp, path)
+
+        with open(path.with_suffix(".json"), "w") as f:
+            index = {
+                "data": path.name,
+                "masks": masks is not None,
+                "names": [n for v in names or [] for n in v.splitlines() if n],
+                "segments": segments,
+            }
+
+            json.dump(index, f, indent="\t", separators=(",", ": "))
+
+        return (None,)
+
+
+class Load_Pack:
+    @classmethod
+    def INPUT_TYPES(cls):
+        path = os.path.join(get_output_directory(), "pack.json")
+
+        return {
+            "required": {
+                "path": ("STRING", {"default": path}),
+            },
+        }
+
+    CATEGORY = "Zuellni/Image"
+    FUNCTION = "process"
+    OUTPUT_IS_LIST = (True, True)
+    RETURN_NAMES = ("IMAGES", "MASKS")
+    RETURN_TYPES = ("IMAGE", "MASK")
+
+    def process(self, path):
+        path = Path(path)
+
+        with open(path, "r") as f:
+            index = json.load(f)
+
+        data = np.memmap(path.with_name(index["data"]), np.uint8, "c")
         images = []
+        masks = []
 
-        for image in pil_images:
-            image = TF.to_tensor(image)
-            image[:3, image[3, :, :] == 0] = 0
-            images.append(image)
+        for segment in index["segments"]:
+            shape = segment["shape"]
+            count = int(np.prod(shape))
+            offset = segment["offset"]
+            image = data[offset : offset + count].reshape(shape)
+            image = torch.from_numpy(image)
 
-        min_height = min([i.shape[1] for i in images])
-        min_width = min([i.shape[2] for i in images])
-        min_dim = min(min_height, min_width) // 8 * 8
-        images = [TF.resize(i, min_dim) for i in images]
+            images.append(image[:, :, :, :3].float().div_(255))
 
-        min_height = min([i.shape[1] for i in images]) // 8 * 8
-        min_width = min([i.shape[2] for i in images]) // 8 * 8
-        images = [TF.center_crop(i, (min_height, min_width)) for i in images]
+            if index["masks"]:
+                masks.append(image[:, :, :, 3].float().div_(255))
+            else:
+                masks.append(torch.ones(shape[:3]))
 
-        images = torch.stack(images)
-        images = images.permute(0, 2, 3, 1)
-        masks = images[:, :, :, 3]
-        images = images[:, :, :, :3]
         return (images, masks)
 
 
@@ -74,12 +1140,23 @@ class Saver:
             "required": {
                 "images": ("IMAGE",),
                 "output_dir": ("STRING", {"default": get_output_directory()}),
-                "format": (["gif", "grid", "jpg", "png"], {"default": "png"}),
+                "format": (
+                    ["apng", "gif", "grid", "jpg", "png", "tar", "tiles", "webp"],
+                    {"default": "png"},
+                ),
                 "optimize": ([False, True], {"default": False}),
                 "fps": ("INT", {"default": 0, "min": 0, "max": 1000}),
             },
             "optional": {
                 "masks": ("MASK",),
+                "background": ([False, True], {"default": False}),
+                "workers": ("INT", {"default": 0, "min": 0, "max": 256}),
+                "palette": (["frame", "global"], {"default": "frame"}),
+                "dedup": (["off", "skip", "link"], {"default": "off"}),
+                "shard_mb": ("INT", {"default": 1024, "min": 1, "max": 65536}),
+                "manifest": ([False, True], {"default": False}),
+                "metadata": ("STRING", {"default": ""}),
+                "thumbnails": ("STRING", {"default": ""}),
             },
         }
 
@@ -88,13 +1165,32 @@ class Saver:
     OUTPUT_NODE = True
     RETURN_TYPES = ()
 
-    def process(self, images, output_dir, format, optimize, fps, masks=None):
+    def process(
+        self,
+        images,
+        output_dir,
+        format,
+        optimize,
+        fps,
+        masks=None,
+        background=False,
+        workers=0,
+        palette="frame",
+        dedup="off",
+        shard_mb=1024,
+        manifest=False,
+        metadata="",
+        thumbnails="",
+    ):
+        global _writer
+
+        while _errors:
+            error = _errors.pop(0)
+            print(f"[\033[94mZuellni\033[0m]: Couldn't save images: {error}")
+
         output_dir = Path(output_dir)
         output_dir.mkdir(parents=True, exist_ok=True)
 
-        def output(extension):
-            return output_dir / f"{uuid4().hex[:16]}.{extension}"
-
         if masks is not None:
             masks = masks.unsqueeze(-1)
             images = torch.cat((images, masks), dim=-1)
@@ -102,25 +1198,30 @@ class Saver:
         images = images.permute(0, 3, 1, 2)
         images = torch.clamp(images * 255, 0, 255)
         images = images.to("cpu", torch.uint8)
-        pil_images = [TF.to_pil_image(i) for i in images]
-
-        if format == "gif":
-            pil_images[0].save(
-                output(format),
-                append_images=pil_images[1:],
-                disposal=2,
-                duration=1 / fps * 1000 if fps else 0,
-                loop=0,
-                optimize=optimize,
-                save_all=True,
-            )
-        elif format == "grid":
-            nrow = fps if fps else int(-(images.shape[0] ** 0.5 // -1))
-            images = make_grid(images, nrow=nrow, padding=0)
-            images = TF.to_pil_image(images)
-            images.save(output("jpg"), optimize=optimize)
+        sizes = [int(s) for s in re.findall(r"[0-9]+", thumbnails) if int(s)]
+        task = partial(
+            write_images,
+            images,
+            output_dir,
+            format,
+            optimize,
+            fps,
+            workers,
+            palette,
+            dedup,
+            shard_mb,
+            manifest,
+            metadata,
+            sizes,
+        )
+
+        if background:
+            if _writer is None:
+                _writer = ThreadPoolExecutor(2)
+
+            _pending.acquire()
+            _writer.submit(task).add_done_callback(writer_done)
         else:
-            for image in pil_images:
-                image.save(output(format), optimize=optimize)
+            task()
 
         return (None,)
\ No newline at end of file
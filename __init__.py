@@ -1,9 +1,27 @@
+import hashlib
 import importlib
 import inspect
 import json
+import os
+import re
 import subprocess
+import sys
+import threading
+import time
+from copy import deepcopy
+from importlib import metadata
 from pathlib import Path
 
+try:
+    from packaging.requirements import InvalidRequirement, Requirement
+except ImportError:
+    Requirement = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 NODE_CLASS_MAPPINGS = {}
 NODE_DISPLAY_NAME_MAPPINGS = {}
 
@@ -12,6 +30,10 @@ config = {
         "Install Requirements": False,
         "Update Repository": False,
         "Quiet Update": True,
+        "Update Timeout": 600,
+        "Lazy Load": True,
+        "Watch Config": False,
+        "Watch Interval": 5,
     },
     "Load Nodes": {
         "Aesthetic": True,
@@ -26,53 +48,366 @@ path = Path(__file__)
 git_path = path.parent
 config_path = path.with_name("config.json")
 req_path = path.with_name("requirements.txt")
-first_run = False
+hash_path = path.with_name(".requirements")
+profile_path = path.with_name("profile.json")
+profile = {}
+
+defaults = deepcopy(config)
+families = {}
+
+
+def read():
+    if config_path.is_file():
+        try:
+            with open(config_path, "r") as f:
+                try:
+                    return json.load(f)
+                except:
+                    print("[\033[94mZuellni\033[0m]: Invalid config. Loading defaults...")
+        except:
+            print("[\033[94mZuellni\033[0m]: Couldn't open config. Loading defaults...")
+
 
-if config_path.is_file():
+def merge(data):
+    merged = deepcopy(defaults)
+
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key in merged and isinstance(value, dict):
+                for k, v in value.items():
+                    if k in merged[key]:
+                        merged[key][k] = v
+
+    return merged
+
+
+def stat():
     try:
-        with open(config_path, "r") as f:
-            try:
-                dict = json.load(f)
-
-                for key, value in dict.items():
-                    if key in config:
-                        for k, v in value.items():
-                            if k in config[key]:
-                                config[key][k] = v
-            except:
-                print("[\033[94mZuellni\033[0m]: Invalid config. Loading defaults...")
-    except:
-        print("[\033[94mZuellni\033[0m]: Couldn't open config. Loading defaults...")
-else:
-    first_run = True
+        return config_path.stat().st_mtime_ns
+    except OSError:
+        return None
 
-try:
-    with open(config_path, "w") as f:
-        json.dump(config, f, indent="\t", separators=(",", ": "))
-except:
-    print("[\033[94mZuellni\033[0m]: Couldn't save config. Proceeding...")
+
+mtime = stat()
+data = read()
+config = merge(data)
+
+if data != config:
+    try:
+        with open(config_path, "w") as f:
+            json.dump(config, f, indent="\t", separators=(",", ": "))
+
+        mtime = stat()
+    except:
+        print("[\033[94mZuellni\033[0m]: Couldn't save config. Proceeding...")
 
 quiet = ["-q"] if config["Settings"]["Quiet Update"] else []
+status = {"fetch": None, "merge": None, "install": None}
+worker = None
+
+
+def run(task, args):
+    status[task] = "running"
+    env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
 
+    try:
+        result = subprocess.run(
+            args, env=env, timeout=config["Settings"]["Update Timeout"]
+        )
+
+        status[task] = "failed" if result.returncode else "done"
+    except subprocess.TimeoutExpired:
+        status[task] = "timed out"
+    except OSError:
+        status[task] = "failed"
+
+    print(f"[\033[94mZuellni\033[0m]: {task.capitalize()} {status[task]}.")
+    return status[task] == "done"
+
+
+# Updates are only fetched in the background and get merged here on the next
+# start, before anything else is imported from the working tree.
 if config["Settings"]["Update Repository"]:
-    print("[\033[94mZuellni\033[0m]: Updating repository...")
-    subprocess.run(["git", "-C", git_path, "pull"] + quiet)
+    run("merge", ["git", "-C", git_path, "merge", "--ff-only"] + quiet)
+
+from .manifest import MANIFEST
+
+
+def fingerprint():
+    try:
+        return hashlib.sha256(req_path.read_bytes()).hexdigest()
+    except OSError:
+        return ""
+
+
+def stored():
+    try:
+        return hash_path.read_text().strip()
+    except OSError:
+        return ""
+
+
+def store(value):
+    if stored() != value:
+        try:
+            hash_path.write_text(value)
+        except OSError:
+            pass
+
+
+def installed():
+    if not req_path.is_file():
+        return False
+
+    for line in req_path.read_text().splitlines():
+        line = line.split(" #")[0].strip()
+
+        if not line or line.startswith("#"):
+            continue
+
+        if "://" in line:
+            url, _, marker = line.partition(";")
+            name = url.rsplit("/", 1)[-1].split("-")[0]
+            line = f"{name} @ {url.strip()}" + (f" ; {marker}" if marker else "")
+
+        if Requirement is None:
+            try:
+                metadata.version(re.match(r"[\w.-]+", line)[0])
+            except metadata.PackageNotFoundError:
+                return False
+
+            continue
+
+        try:
+            req = Requirement(line)
+        except InvalidRequirement:
+            return False
+
+        if req.marker and not req.marker.evaluate():
+            continue
+
+        try:
+            version = metadata.version(req.name)
+        except metadata.PackageNotFoundError:
+            return False
+
+        if not req.specifier.contains(version, prereleases=True):
+            return False
+
+    return True
+
+
+def outdated():
+    if not any(config["Load Nodes"][key] for key in MANIFEST):
+        return False
+
+    if stored() in (fingerprint(), f"failed {fingerprint()}"):
+        return False
+
+    if stored() and not config["Settings"]["Install Requirements"]:
+        return False
+
+    if installed():
+        store(fingerprint())
+        return False
+
+    return True
+
+
+def install():
+    if outdated():
+        print("[\033[94mZuellni\033[0m]: Installing requirements...")
+        args = [sys.executable, "-m", "pip", "install", "-U", "-r", req_path]
+        failed = "" if run("install", args + quiet) else "failed "
+        store(failed + fingerprint())
+
+
+def update():
+    if config["Settings"]["Update Repository"]:
+        print("[\033[94mZuellni\033[0m]: Fetching updates...")
+        run("fetch", ["git", "-C", git_path, "fetch"] + quiet)
+
+    install()
+
+
+if config["Settings"]["Update Repository"] or outdated():
+    worker = threading.Thread(target=update, daemon=True)
+    worker.start()
+
+
+def rss():
+    return psutil.Process().memory_info().rss if psutil else 0
+
+
+def report():
+    try:
+        with open(profile_path, "w") as f:
+            json.dump(profile, f, indent="\t", separators=(",", ": "))
+    except:
+        print("[\033[94mZuellni\033[0m]: Couldn't save profile. Proceeding...")
+
+
+def load(key):
+    if key in MANIFEST and worker is not None:
+        worker.join()
+
+    name = f"{__name__}.Nodes.{key}"
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    start_time = time.perf_counter()
+    start_rss = rss()
+    module = importlib.import_module(f".Nodes.{key}", package=__name__)
+
+    profile.setdefault(key, {})
+    profile[key]["import_time"] = round(time.perf_counter() - start_time, 4)
+    profile[key]["rss_delta"] = rss() - start_rss
+
+    return module
+
+
+def proxy(key, name, info):
+    def INPUT_TYPES(cls):
+        return info["INPUT_TYPES"]
+
+    def process(self, **kwargs):
+        if self.node is None:
+            cls = getattr(load(key), name)
+            report()
+
+            if cls.INPUT_TYPES() != info["INPUT_TYPES"]:
+                print(f"[\033[94mZuellni\033[0m]: Outdated manifest for {key} {name}.")
+
+            self.node = cls()
+
+        return getattr(self.node, info["FUNCTION"])(**kwargs)
+
+    attrs = {k: v for k, v in info.items() if k != "INPUT_TYPES"}
+    attrs["INPUT_TYPES"] = classmethod(INPUT_TYPES)
+    attrs[info["FUNCTION"]] = process
+    attrs["node"] = None
+    return type(name, (), attrs)
+
+
+def sync(names):
+    nodes = sys.modules.get("nodes")
+
+    if nodes is None or not hasattr(nodes, "NODE_CLASS_MAPPINGS"):
+        return
+
+    # Server handlers iterate these mappings, so build new dicts and swap them
+    # in rather than changing the live ones from this thread.
+    classes = dict(nodes.NODE_CLASS_MAPPINGS)
+    display = dict(nodes.NODE_DISPLAY_NAME_MAPPINGS)
+
+    for node in names:
+        if node in NODE_CLASS_MAPPINGS:
+            classes[node] = NODE_CLASS_MAPPINGS[node]
+            display[node] = NODE_DISPLAY_NAME_MAPPINGS[node]
+        else:
+            classes.pop(node, None)
+            display.pop(node, None)
+
+    nodes.NODE_CLASS_MAPPINGS = classes
+    nodes.NODE_DISPLAY_NAME_MAPPINGS = display
+
+
+def register(key, classes):
+    families[key] = []
+
+    for name, cls in classes:
+        node = f"Zuellni {key} {name}".replace("_", " ")
+        disp = f"{key} {name}".replace("_", " ")
+
+        NODE_CLASS_MAPPINGS[node] = cls
+        NODE_DISPLAY_NAME_MAPPINGS[node] = disp
+        families[key].append(node)
+
+
+def unregister(key):
+    names = families.pop(key, [])
+
+    for node in names:
+        NODE_CLASS_MAPPINGS.pop(node, None)
+        NODE_DISPLAY_NAME_MAPPINGS.pop(node, None)
+
+    sync(names)
+
+
+def enable(key):
+    lazy = config["Settings"]["Lazy Load"] and key in MANIFEST
+
+    if lazy:
+        classes = [(n, proxy(key, n, i)) for n, i in MANIFEST[key].items()]
+    else:
+        module = load(key)
+        classes = inspect.getmembers(module, inspect.isclass)
+        classes = [(n, c) for n, c in classes if c.__module__ == module.__name__]
+
+    register(key, classes)
+    profile.setdefault(key, {"import_time": 0.0, "rss_delta": 0})
+    profile[key].update(lazy=lazy, classes=len(classes))
+
+
+def watch():
+    global mtime, worker
+
+    while True:
+        time.sleep(config["Settings"]["Watch Interval"])
+        current = stat()
+
+        if current is None or current == mtime:
+            continue
+
+        mtime = current
+        data = read()
+
+        if data is None:
+            continue
+
+        merged = merge(data)
+        config["Settings"].update(merged["Settings"])
+
+        for key, value in merged["Load Nodes"].items():
+            if value == config["Load Nodes"][key]:
+                continue
+
+            config["Load Nodes"][key] = value
+
+            try:
+                if value:
+                    if key in MANIFEST and outdated():
+                        if worker is not None:
+                            worker.join()
+
+                        worker = threading.Thread(target=install, daemon=True)
+                        worker.start()
+
+                    enable(key)
+                    sync(families[key])
+                else:
+                    unregister(key)
+                    profile.pop(key, None)
+            except Exception as e:
+                print(f"[\033[94mZuellni\033[0m]: Couldn't toggle {key}: {e}")
+                continue
+
+            print(f"[\033[94mZuellni\033[0m]: {'En' if value else 'Dis'}abled {key}.")
+
+        report()
 
-if config["Settings"]["Install Requirements"] or first_run:
-    print("[\033[94mZuellni\033[0m]: Installing requirements...")
-    subprocess.run(["python", "-m", "pip", "install", "-U", "-r", req_path] + quiet)
 
 for key, value in config["Load Nodes"].items():
     if value:
-        module = importlib.import_module(f".Nodes.{key}", package=__name__)
-
-        for name, cls in inspect.getmembers(module, inspect.isclass):
-            if cls.__module__ == module.__name__:
-                key = key.replace("_", " ")
-                name = name.replace("_", " ")
+        enable(key)
 
-                node = f"Zuellni {key} {name}"
-                disp = f"{key} {name}"
+report()
+eager = {k: v for k, v in profile.items() if not v["lazy"]}
+lazy = ", ".join(k for k, v in profile.items() if v["lazy"]) or "none"
+times = ", ".join(f"{k} {v['import_time']:.2f}s" for k, v in eager.items())
+total = sum(v["import_time"] for v in eager.values())
+print(f"[\033[94mZuellni\033[0m]: Loaded nodes in {total:.2f}s ({times}), deferred {lazy}.")
 
-                NODE_CLASS_MAPPINGS[node] = cls
-                NODE_DISPLAY_NAME_MAPPINGS[node] = disp
\ No newline at end of file
+if config["Settings"]["Watch Config"]:
+    threading.Thread(target=watch, daemon=True).start()
@@ -0,0 +1,174 @@
+# Static description of the node families that pull in heavy dependencies
+# (transformers, diffusers, accelerate, bitsandbytes). These are registered
+# as proxies at startup and their modules are only imported on first use.
+# Keep in sync with Nodes/Aesthetic.py and Nodes/IF.py.
+
+_SEED = ("INT", {"default": 0, "min": 0, "max": 0xFFFFFFFFFFFFFFFF})
+_STEPS = ("INT", {"default": 20, "min": 1, "max": 10000})
+_CFG = ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0})
+_DEVICE = ("STRING", {"default": ""})
+_PROMPT = ("STRING", {"default": "", "multiline": True})
+_SCHEDULERS = (["default", "sde-dpmsolver++"], {"default": "default"})
+_BOOL = ([False, True], {"default": False})
+
+MANIFEST = {
+    "Aesthetic": {
+        "Loader": {
+            "INPUT_TYPES": {
+                "required": {
+                    "aesthetic": _BOOL,
+                    "style": _BOOL,
+                    "waifu": _BOOL,
+                    "age": _BOOL,
+                },
+            },
+            "CATEGORY": "Zuellni/Aesthetic",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("MODELS",),
+            "RETURN_TYPES": ("LIST",),
+        },
+        "Select": {
+            "INPUT_TYPES": {
+                "required": {
+                    "count": ("INT", {"default": 1, "min": 0, "max": 64}),
+                },
+                "optional": {
+                    "images": ("IMAGE",),
+                    "latents": ("LATENT",),
+                    "masks": ("MASK",),
+                    "models": ("LIST",),
+                },
+            },
+            "CATEGORY": "Zuellni/Aesthetic",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("IMAGES", "LATENTS", "MASKS", "SCORES"),
+            "RETURN_TYPES": ("IMAGE", "LATENT", "MASK", "STRING"),
+        },
+    },
+    "IF": {
+        "Load_Encoder": {
+            "INPUT_TYPES": {
+                "required": {
+                    "model": (["4-bit", "8-bit", "16-bit"], {"default": "4-bit"}),
+                    "device": _DEVICE,
+                },
+            },
+            "CATEGORY": "Zuellni/IF",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("MODEL",),
+            "RETURN_TYPES": ("S0_MODEL",),
+        },
+        "Load_Stage_I": {
+            "INPUT_TYPES": {
+                "required": {
+                    "model": (
+                        ["medium", "large", "extra large"],
+                        {"default": "medium"},
+                    ),
+                    "scheduler": _SCHEDULERS,
+                    "karrasSigmas": ("BOOLEAN", {"default": True}),
+                    "device": _DEVICE,
+                },
+            },
+            "CATEGORY": "Zuellni/IF",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("MODEL",),
+            "RETURN_TYPES": ("S1_MODEL",),
+        },
+        "Load_Stage_II": {
+            "INPUT_TYPES": {
+                "required": {
+                    "model": (["medium", "large"], {"default": "medium"}),
+                    "scheduler": _SCHEDULERS,
+                    "karrasSigmas": ("BOOLEAN", {"default": True}),
+                    "device": _DEVICE,
+                },
+            },
+            "CATEGORY": "Zuellni/IF",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("MODEL",),
+            "RETURN_TYPES": ("S2_MODEL",),
+        },
+        "Load_Stage_III": {
+            "INPUT_TYPES": {
+                "required": {
+                    "device": _DEVICE,
+                },
+            },
+            "CATEGORY": "Zuellni/IF",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("MODEL",),
+            "RETURN_TYPES": ("S3_MODEL",),
+        },
+        "Encode": {
+            "INPUT_TYPES": {
+                "required": {
+                    "model": ("S0_MODEL",),
+                    "positive": _PROMPT,
+                    "negative": _PROMPT,
+                },
+            },
+            "CATEGORY": "Zuellni/IF",
+            "FUNCTION": "process",
+            "RETURN_TYPES": ("POSITIVE", "NEGATIVE"),
+        },
+        "Stage_I": {
+            "INPUT_TYPES": {
+                "required": {
+                    "model": ("S1_MODEL",),
+                    "positive": ("POSITIVE",),
+                    "negative": ("NEGATIVE",),
+                    "width": ("INT", {"default": 64, "min": 8, "max": 128, "step": 8}),
+                    "height": ("INT", {"default": 64, "min": 8, "max": 128, "step": 8}),
+                    "batch_size": ("INT", {"default": 1, "min": 1, "max": 64}),
+                    "seed": _SEED,
+                    "steps": _STEPS,
+                    "cfg": _CFG,
+                },
+            },
+            "CATEGORY": "Zuellni/IF",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("IMAGES",),
+            "RETURN_TYPES": ("IMAGE",),
+        },
+        "Stage_II": {
+            "INPUT_TYPES": {
+                "required": {
+                    "model": ("S2_MODEL",),
+                    "positive": ("POSITIVE",),
+                    "negative": ("NEGATIVE",),
+                    "images": ("IMAGE",),
+                    "seed": _SEED,
+                    "steps": _STEPS,
+                    "cfg": _CFG,
+                },
+            },
+            "CATEGORY": "Zuellni/IF",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("IMAGES",),
+            "RETURN_TYPES": ("IMAGE",),
+        },
+        "Stage_III": {
+            "INPUT_TYPES": {
+                "required": {
+                    "model": ("S3_MODEL",),
+                    "images": ("IMAGE",),
+                    "tile_size": (
+                        "INT",
+                        {"default": 0, "min": 0, "max": 1024, "step": 64},
+                    ),
+                    "noise": ("INT", {"default": 20, "min": 0, "max": 100}),
+                    "seed": _SEED,
+                    "steps": _STEPS,
+                    "cfg": _CFG,
+                    "positive": _PROMPT,
+                    "negative": _PROMPT,
+                },
+            },
+            "CATEGORY": "Zuellni/IF",
+            "FUNCTION": "process",
+            "RETURN_NAMES": ("IMAGES",),
+            "RETURN_TYPES": ("IMAGE",),
+        },
+    },
+}